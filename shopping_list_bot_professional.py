@@ -4,11 +4,21 @@ Bot de Lista de Mercado para Telegram - Com Modo Mercado (HTML)
 Usa HTML para texto riscado funcionar corretamente.
 """
 
+import hashlib
+import html
 import logging
 import os
 import asyncio
-from datetime import datetime
+import time
+
+import orjson
+try:
+    import uvloop
+except ImportError:
+    # uvloop não existe no Windows: segue com o loop padrão do asyncio
+    uvloop = None
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
+from telegram.constants import ParseMode
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -16,14 +26,19 @@ from telegram.ext import (
     ContextTypes,
     filters,
     CallbackQueryHandler,
+    AIORateLimiter,
+    Defaults,
 )
-from telegram.error import BadRequest
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
 
 # Configurar logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+    level=getattr(logging, os.getenv('LOG_LEVEL', 'INFO').upper(), logging.INFO)
 )
+# httpx registra cada chamada à API em INFO: só avisos e erros
+logging.getLogger('httpx').setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 # Estados
@@ -32,114 +47,374 @@ STATE_ADDING = 1
 STATE_REMOVING = 2
 STATE_MARKET_MODE = 3
 
+# Chats com lista vazia e parados há mais que isso saem da memória (segundos)
+CHAT_IDLE_TTL = float(os.getenv('CHAT_IDLE_TTL', 24 * 3600))
+EVICT_INTERVAL = 5 * 60
+
+# Prefixo do callback_data dos itens no modo mercado
+_TOGGLE_PREFIX = 'toggle_'
+_TOGGLE_PREFIX_LEN = len(_TOGGLE_PREFIX)
+
+# Janela de agrupamento das edições do menu (segundos)
+EDIT_DEBOUNCE = 0.25
+
+# Snapshot em disco das listas (sobrevive a reinícios)
+SNAPSHOT_PATH = os.getenv('SNAPSHOT_PATH', 'shopping_lists.json')
+SNAPSHOT_DELAY = 2.0
+
+# Hash dos comandos já enviados ao Telegram (evita set_my_commands repetido)
+COMMANDS_HASH_PATH = os.getenv('COMMANDS_HASH_PATH', '.bot_commands_hash')
+
 # Armazenamento
 shopping_lists = {}
+# Só guarda quem está no meio de uma ação; STATE_NONE é a ausência da chave
 user_states = {}
-messages_to_delete = {}
-menu_messages = {}
+_snapshot_task = None
+_snapshot_lock = asyncio.Lock()
+# Há mudanças ainda não serializadas para o snapshot
+_snapshot_dirty = False
+
+
+class OrjsonRequest(HTTPXRequest):
+    """HTTPXRequest que decodifica as respostas do Telegram com orjson"""
+    
+    @staticmethod
+    def parse_json_payload(payload: bytes) -> dict:
+        try:
+            return orjson.loads(payload)
+        except orjson.JSONDecodeError:
+            # UTF-8 inválido etc.: o parser padrão substitui os bytes ou loga o erro
+            return HTTPXRequest.parse_json_payload(payload)
+
+
+class Item:
+    """Item da lista (sem __dict__ por instância)"""
+    __slots__ = ('name', 'name_html')
+    
+    def __init__(self, name: str):
+        self.name = name
+        # Escapado uma única vez; usado em todo texto com parse_mode HTML
+        self.name_html = html.escape(name)
+
+
+class ChatList:
+    """Lista de compras de um chat (sem __dict__ por instância)"""
+    __slots__ = ('items', 'bought_flags', 'names_folded', 'pending', 'bought', 'menu_text', 'numbered_text',
+                 'menu_message_id', 'menu_rendered', 'market_buttons', 'pending_shown', 'last_activity')
+    
+    def __init__(self):
+        self.items = []
+        # Marcações em paralelo a items (1 = comprado)
+        self.bought_flags = bytearray()
+        self.names_folded = set()
+        self.pending = 0
+        self.bought = 0
+        # Texto do menu já montado; None quando a lista mudou
+        self.menu_text = None
+        # Lista numerada do prompt de remoção; só depende dos nomes
+        self.numbered_text = None
+        # Mensagem de menu do chat e o que ela exibe agora ((texto, tem_itens) ou None)
+        self.menu_message_id = None
+        self.menu_rendered = None
+        # Linhas (⬜, ✅) do modo mercado já montadas; None quando os itens mudaram
+        self.market_buttons = None
+        # (message_id, pendentes) do texto do modo mercado na tela
+        self.pending_shown = None
+        self.last_activity = time.monotonic()
+
+
+pending_edit_tasks = {}
+last_edit_request = {}
+_chat_locks = {}
 
 
 def get_user_state_key(chat_id, user_id):
-    return f"{chat_id}_{user_id}"
+    return (chat_id, user_id)
+
+
+def invalidate_menu_cache(chat_id):
+    """Esquece o último menu renderizado (a mensagem passou a mostrar outra coisa)"""
+    chat = shopping_lists.get(chat_id)
+    if chat is not None:
+        chat.menu_rendered = None
+    cancel_scheduled_menu_edit(chat_id)
+
+
+def cancel_scheduled_menu_edit(chat_id):
+    """Cancela a edição agendada do menu, se ainda estiver aguardando"""
+    task = pending_edit_tasks.pop(chat_id, None)
+    if task is not None:
+        task.cancel()
+
+
+def init_list(chat_id) -> ChatList:
+    """Inicializa lista se não existir e a retorna"""
+    chat = shopping_lists.get(chat_id)
+    if chat is None:
+        chat = shopping_lists[chat_id] = ChatList()
+    else:
+        chat.last_activity = time.monotonic()
+    return chat
+
+
+def _dump_snapshot() -> bytes:
+    """Serializa as listas como {chat_id: [[nome, comprado], ...]}"""
+    return orjson.dumps({
+        str(chat_id): [
+            (item.name, bool(flag)) for item, flag in zip(chat.items, chat.bought_flags)
+        ]
+        for chat_id, chat in shopping_lists.items()
+        if chat.items
+    })
+
+
+def _write_snapshot(data: bytes):
+    """Grava o snapshot de forma atômica"""
+    tmp_path = f"{SNAPSHOT_PATH}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        # Garante o conteúdo no disco antes da troca (queda de energia não zera o arquivo)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, SNAPSHOT_PATH)
+
+
+def load_snapshot():
+    """Restaura as listas salvas no último snapshot"""
+    try:
+        with open(SNAPSHOT_PATH, 'rb') as f:
+            data = orjson.loads(f.read())
+    except FileNotFoundError:
+        return
+    except (OSError, orjson.JSONDecodeError) as e:
+        logger.error("❌ Snapshot ilegível: %s", e)
+        return
+    
+    # Monta tudo à parte: um snapshot com formato inesperado não deixa listas pela metade
+    restored = {}
+    try:
+        for chat_id, saved_items in data.items():
+            chat = restored[int(chat_id)] = ChatList()
+            for entry in saved_items:
+                # Cada item é [nome, comprado]; uma string de 2 letras também "desempacotaria"
+                if not (isinstance(entry, list) and len(entry) == 2 and isinstance(entry[0], str)):
+                    raise TypeError(f"item inválido: {entry!r}")
+                name, bought = entry
+                name_folded = name.casefold()
+                # Arquivo editado à mão pode repetir nomes: mantém só o primeiro
+                if name_folded in chat.names_folded:
+                    continue
+                chat.items.append(Item(name))
+                chat.bought_flags.append(1 if bought else 0)
+                chat.names_folded.add(name_folded)
+            chat.bought = chat.bought_flags.count(1)
+            chat.pending = len(chat.items) - chat.bought
+    except (AttributeError, TypeError, ValueError) as e:
+        logger.error("❌ Snapshot com formato inválido: %s", e)
+        return
+    
+    shopping_lists.update(restored)
+    logger.info("✅ %d lista(s) restaurada(s)", len(restored))
+
+
+async def _snapshot_later():
+    """Aguarda a janela e grava um único snapshot para todas as mudanças"""
+    global _snapshot_task, _snapshot_dirty
+    await asyncio.sleep(SNAPSHOT_DELAY)
+    _snapshot_task = None
+    # Uma gravação por vez: a seguinte espera e sempre leva o estado mais novo
+    async with _snapshot_lock:
+        data = _dump_snapshot()
+        _snapshot_dirty = False
+        try:
+            await asyncio.to_thread(_write_snapshot, data)
+        except OSError as e:
+            logger.error("❌ Falha ao salvar snapshot: %s", e)
 
 
-def init_list(chat_id):
-    """Inicializa lista se não existir"""
-    if chat_id not in shopping_lists:
-        shopping_lists[chat_id] = {'items': [], 'created_at': datetime.now()}
+def schedule_snapshot():
+    """Marca as listas como alteradas; mudanças em sequência viram uma gravação"""
+    global _snapshot_task, _snapshot_dirty
+    _snapshot_dirty = True
+    if _snapshot_task is None:
+        _snapshot_task = asyncio.create_task(_snapshot_later())
 
 
-def get_list_text(items: list, show_status: bool = True) -> str:
+async def save_snapshot_now(application: Application) -> None:
+    """Grava o snapshot pendente ao desligar o bot (assinatura exigida pelo post_shutdown)"""
+    global _snapshot_dirty
+    if _snapshot_task is not None:
+        # A tarefa ainda está na espera (ela zera _snapshot_task antes de gravar)
+        _snapshot_task.cancel()
+    # Aguarda uma gravação em andamento: as duas usariam o mesmo .tmp
+    async with _snapshot_lock:
+        # Só grava se houver mudança que nenhuma gravação levou
+        if not _snapshot_dirty:
+            return
+        data = _dump_snapshot()
+        _snapshot_dirty = False
+        try:
+            _write_snapshot(data)
+        except OSError as e:
+            logger.error("❌ Falha ao salvar snapshot: %s", e)
+
+
+# Trechos fixos das telas, montados uma única vez
+SEPARATOR = "━" * 15
+_MENU_HEADER = f"🛒 <b>LISTA DE MERCADO</b>\n{SEPARATOR}\n"
+_MENU_SEP = f"\n{SEPARATOR}\n"
+_MENU_EMPTY_TEXT = f"{_MENU_HEADER}📋 Lista vazia\n{SEPARATOR}"
+_MARKET_HEADER = f"🛒 <b>MODO MERCADO</b>\n{SEPARATOR}\nToque nos itens para marcar:\n\n"
+
+# Avisos fixos
+_EMPTY_LIST_NOTICE = "📋 <b>Lista vazia!</b>"
+_ALREADY_EMPTY_NOTICE = "📋 <b>Lista já está vazia!</b>"
+_TOO_SHORT_NOTICE = "❌ <b>Muito curto!</b>"
+_NOT_A_NUMBER_NOTICE = "❌ <b>Digite o número!</b>"
+_CONFIRM_CLEAR_TEXT = "⚠️ <b>Limpar toda a lista?</b>"
+
+_TEXT_INPUT_STATES = frozenset((STATE_ADDING, STATE_REMOVING))
+
+
+class _AwaitingInputFilter(filters.MessageFilter):
+    """Deixa passar só quem está adicionando ou removendo"""
+    __slots__ = ()
+    
+    def filter(self, message) -> bool:
+        user = message.from_user
+        # Sem nenhum estado registrado não há o que procurar
+        if user is None or not user_states:
+            return False
+        return user_states.get(get_user_state_key(message.chat_id, user.id)) in _TEXT_INPUT_STATES
+
+
+# Texto digitado que não é comando (itens e números da remoção); o filtro de
+# estado roda no dispatcher e evita criar uma tarefa para cada conversa do grupo.
+# Só mensagens novas: numa edição update.message é None
+TEXT_INPUT_FILTER = (
+    filters.UpdateType.MESSAGE & filters.TEXT & ~filters.COMMAND
+    & _AwaitingInputFilter(name="AwaitingInput")
+)
+
+
+def get_list_text(chat: ChatList, show_status: bool = True) -> str:
     """Formata a lista de compras usando HTML"""
+    items = chat.items
     if not items:
         return "📋 Lista vazia"
     
-    text = ""
-    for i, item in enumerate(items, 1):
-        name = item['name']
-        bought = item.get('bought', False)
-        
-        if show_status and bought:
-            # Usa <s> para texto riscado em HTML
-            text += f"{i}. <s>{name}</s> ✅\n"
-        else:
-            text += f"{i}. {name}\n"
+    if not show_status:
+        if chat.numbered_text is None:
+            chat.numbered_text = "\n".join(f"{i}. {item.name_html}" for i, item in enumerate(items, 1))
+        return chat.numbered_text
     
-    return text.strip()
+    # Usa <s> para texto riscado em HTML
+    return "\n".join(
+        f"{i}. <s>{item.name_html}</s> ✅" if flag else f"{i}. {item.name_html}"
+        for i, (item, flag) in enumerate(zip(items, chat.bought_flags), 1)
+    )
 
 
-def get_main_menu_text(items: list) -> str:
-    """Texto do menu principal com lista (HTML)"""
-    if items:
-        pending = sum(1 for item in items if not item.get('bought', False))
-        bought = sum(1 for item in items if item.get('bought', False))
-        
-        list_text = get_list_text(items)
-        status = f"📊 <b>{len(items)} item(ns)</b>"
-        if bought > 0:
-            status += f" | ✅ {bought} comprado(s)"
-        
-        return f"🛒 <b>LISTA DE MERCADO</b>\n━━━━━━━━━━━━━━━\n{list_text}\n━━━━━━━━━━━━━━━\n{status}"
+def get_main_menu_text(chat: ChatList) -> str:
+    """Texto do menu principal com lista (HTML), remontado só quando a lista muda"""
+    if chat.menu_text is not None:
+        return chat.menu_text
+    
+    items = chat.items
+    if not items:
+        text = _MENU_EMPTY_TEXT
     else:
-        return "🛒 <b>LISTA DE MERCADO</b>\n━━━━━━━━━━━━━━━\n📋 Lista vazia\n━━━━━━━━━━━━━━━"
+        footer = f"📊 <b>{len(items)} item(ns)</b>"
+        if chat.bought > 0:
+            footer = f"{footer} | ✅ {chat.bought} comprado(s)"
+        text = f"{_MENU_HEADER}{get_list_text(chat)}{_MENU_SEP}{footer}"
+    
+    chat.menu_text = text
+    return text
+
+
+# Teclados fixos (montados uma única vez na carga do módulo)
+_MAIN_MENU_KB_EMPTY = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("➕ Adicionar", callback_data='action_add'),
+        InlineKeyboardButton("➖ Remover", callback_data='action_remove')
+    ],
+    [InlineKeyboardButton("🗑️ Limpar Tudo", callback_data='action_clear')]
+])
+
+_MAIN_MENU_KB_WITH_ITEMS = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("➕ Adicionar", callback_data='action_add'),
+        InlineKeyboardButton("➖ Remover", callback_data='action_remove')
+    ],
+    [InlineKeyboardButton("🛒 Modo Mercado", callback_data='action_market_mode')],
+    [InlineKeyboardButton("🗑️ Limpar Tudo", callback_data='action_clear')]
+])
+
+_CANCEL_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("❌ Cancelar", callback_data='action_cancel')]
+])
+
+_CONFIRM_CLEAR_KB = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("✅ Sim, limpar", callback_data='confirm_clear'),
+        InlineKeyboardButton("❌ Não", callback_data='cancel_clear')
+    ]
+])
+
+# Linhas fixas do teclado do modo mercado
+_MARKET_CONTROLS_ROW = (
+    InlineKeyboardButton("✔️ Finalizar", callback_data='market_finish'),
+    InlineKeyboardButton("❌ Cancelar", callback_data='market_cancel')
+)
+_MARKET_CLEAR_BOUGHT_ROW = (
+    InlineKeyboardButton("🧹 Remover Comprados", callback_data='market_clear_bought'),
+)
 
 
 def get_main_menu_keyboard(has_items: bool = False):
     """Teclado do menu principal"""
-    keyboard = [
-        [
-            InlineKeyboardButton("➕ Adicionar", callback_data='action_add'),
-            InlineKeyboardButton("➖ Remover", callback_data='action_remove')
+    return _MAIN_MENU_KB_WITH_ITEMS if has_items else _MAIN_MENU_KB_EMPTY
+
+
+def get_market_buttons(chat_id: int) -> list:
+    """Linhas (⬜, ✅) de cada item, montadas uma vez por versão da lista"""
+    chat = shopping_lists[chat_id]
+    buttons = chat.market_buttons
+    if buttons is None:
+        buttons = chat.market_buttons = [
+            (
+                (InlineKeyboardButton(f"⬜ {item.name}", callback_data=f'{_TOGGLE_PREFIX}{i}'),),
+                (InlineKeyboardButton(f"✅ {item.name}", callback_data=f'{_TOGGLE_PREFIX}{i}'),)
+            )
+            for i, item in enumerate(chat.items)
         ]
-    ]
-    
-    if has_items:
-        keyboard.append([
-            InlineKeyboardButton("🛒 Modo Mercado", callback_data='action_market_mode')
-        ])
-    
-    keyboard.append([
-        InlineKeyboardButton("🗑️ Limpar Tudo", callback_data='action_clear')
-    ])
-    
-    return InlineKeyboardMarkup(keyboard)
+    return buttons
 
 
-def get_cancel_keyboard():
-    """Teclado de cancelar"""
-    keyboard = [[InlineKeyboardButton("❌ Cancelar", callback_data='action_cancel')]]
-    return InlineKeyboardMarkup(keyboard)
+def invalidate_market_buttons(chat_id: int):
+    """Descarta os botões pré-montados (itens adicionados/removidos)"""
+    shopping_lists[chat_id].market_buttons = None
 
 
-def get_market_mode_keyboard(items: list):
-    """Teclado do modo mercado com checkboxes"""
-    keyboard = []
+def render_market_view(chat_id: int):
+    """Monta texto e teclado do modo mercado numa única passada
     
-    for i, item in enumerate(items):
-        name = item['name']
-        bought = item.get('bought', False)
-        
-        if bought:
-            btn_text = f"✅ {name}"
-        else:
-            btn_text = f"⬜ {name}"
-        
-        keyboard.append([
-            InlineKeyboardButton(btn_text, callback_data=f'toggle_{i}')
-        ])
+    Retorna (texto, teclado, pendentes, comprados).
+    """
+    chat = shopping_lists[chat_id]
+    keyboard = [rows[flag] for rows, flag in zip(get_market_buttons(chat_id), chat.bought_flags)]
+    keyboard.append(_MARKET_CONTROLS_ROW)
     
-    keyboard.append([
-        InlineKeyboardButton("✔️ Finalizar", callback_data='market_finish'),
-        InlineKeyboardButton("❌ Cancelar", callback_data='market_cancel')
-    ])
+    pending = chat.pending
+    bought_count = chat.bought
     
-    has_bought = any(item.get('bought', False) for item in items)
-    if has_bought:
-        keyboard.append([
-            InlineKeyboardButton("🧹 Remover Comprados", callback_data='market_clear_bought')
-        ])
+    if bought_count:
+        keyboard.append(_MARKET_CLEAR_BOUGHT_ROW)
     
-    return InlineKeyboardMarkup(keyboard)
+    text = f"{_MARKET_HEADER}📦 <b>{pending} pendente(s)</b>"
+    
+    return text, InlineKeyboardMarkup(keyboard), pending, bought_count
 
 
 async def delete_message_safe(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: int):
@@ -147,69 +422,259 @@ async def delete_message_safe(context: ContextTypes.DEFAULT_TYPE, chat_id: int,
     try:
         await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
         return True
-    except:
+    except TelegramError:
         return False
 
 
-async def track_message(chat_id: int, user_id: int, message_id: int):
-    """Rastreia mensagem para deletar depois"""
-    key = get_user_state_key(chat_id, user_id)
-    if key not in messages_to_delete:
-        messages_to_delete[key] = []
-    messages_to_delete[key].append(message_id)
+async def _delete_message_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Job do JobQueue: apaga a mensagem indicada em job.data"""
+    await delete_message_safe(context, context.job.chat_id, context.job.data)
 
 
-async def cleanup_messages(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int):
-    """Limpa mensagens rastreadas"""
-    key = get_user_state_key(chat_id, user_id)
-    if key in messages_to_delete:
-        for msg_id in messages_to_delete[key]:
-            await delete_message_safe(context, chat_id, msg_id)
-        messages_to_delete[key] = []
+def delete_message_later(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: int, delay: float):
+    """Agenda a exclusão de uma mensagem sem segurar o handler"""
+    context.job_queue.run_once(_delete_message_job, delay, data=message_id, chat_id=chat_id)
 
 
-async def update_menu(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
-    """Atualiza o menu existente ou cria um novo"""
-    init_list(chat_id)
-    items = shopping_lists[chat_id]['items']
-    menu_text = get_main_menu_text(items)
+def get_live_menu_message(chat_id):
+    """ID da mensagem de menu do chat (se ela sumiu, a edição falha e outra é enviada)"""
+    chat = shopping_lists.get(chat_id)
+    return chat.menu_message_id if chat is not None else None
+
+
+def remember_menu_message(chat_id, message_id):
+    """Registra a mensagem recém-enviada como menu do chat"""
+    init_list(chat_id).menu_message_id = message_id
+
+
+def _chat_lock(chat_id) -> asyncio.Lock:
+    """Lock do chat (chats diferentes continuam rodando em paralelo)"""
+    lock = _chat_locks.get(chat_id)
+    if lock is None:
+        lock = _chat_locks[chat_id] = asyncio.Lock()
+    return lock
+
+
+async def edit_or_send_menu(context: ContextTypes.DEFAULT_TYPE, chat_id: int, text: str, reply_markup,
+                            rendered=None):
+    """Edita a mensagem de menu do chat ou, se não houver uma utilizável, envia outra
+    
+    rendered: o que a mensagem passa a exibir; se ela já exibe isso, nada é enviado.
+    """
+    # Serializa por chat: dois updates simultâneos não podem mandar dois menus novos,
+    # e o cache só é lido e gravado aqui dentro (não fica com o conteúdo de outra edição)
+    async with _chat_lock(chat_id):
+        chat = init_list(chat_id)
+        message_id = get_live_menu_message(chat_id)
+        if message_id is not None:
+            # Menu já exibe exatamente isso: evita uma chamada à API
+            if rendered is not None and chat.menu_rendered == rendered:
+                return
+            try:
+                await context.bot.edit_message_text(
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    text=text,
+                    reply_markup=reply_markup
+                )
+                chat.menu_rendered = rendered
+                return
+            except BadRequest as e:
+                if 'not modified' in str(e):
+                    chat.menu_rendered = rendered
+                    return
+                # Mensagem apagada pelo usuário nesse meio tempo
+        
+        msg = await context.bot.send_message(
+            chat_id=chat_id,
+            text=text,
+            reply_markup=reply_markup
+        )
+        remember_menu_message(chat_id, msg.message_id)
+        chat.menu_rendered = rendered
+
+
+async def update_menu(context: ContextTypes.DEFAULT_TYPE, chat_id: int, header: str = ""):
+    """Atualiza o menu existente ou cria um novo (header: aviso acima da lista)"""
+    cancel_scheduled_menu_edit(chat_id)
+    chat = init_list(chat_id)
+    items = chat.items
+    menu_text = get_main_menu_text(chat)
+    if header:
+        menu_text = f"{header}\n\n{menu_text}"
     has_items = len(items) > 0
     
-    if chat_id in menu_messages:
+    await edit_or_send_menu(
+        context, chat_id, menu_text, get_main_menu_keyboard(has_items),
+        rendered=(menu_text, has_items)
+    )
+
+
+async def show_menu_on_query(query, chat_id: int):
+    """Volta a mensagem do botão para o menu principal, sem edições repetidas"""
+    # Mesmo lock de edit_or_send_menu: comparação, edição e cache sem outra edição no meio
+    async with _chat_lock(chat_id):
+        chat = shopping_lists[chat_id]
+        menu_text = get_main_menu_text(chat)
+        has_items = len(chat.items) > 0
+        rendered = (menu_text, has_items)
+        is_menu = query.message.message_id == chat.menu_message_id
+        
+        # Clique duplo: a mensagem já mostra exatamente isso
+        if is_menu and chat.menu_rendered == rendered:
+            return
+        
         try:
+            await query.edit_message_text(
+                menu_text,
+                reply_markup=get_main_menu_keyboard(has_items)
+            )
+        except BadRequest as e:
+            if 'not modified' not in str(e).lower():
+                raise
+        
+        if is_menu:
+            chat.menu_rendered = rendered
+
+
+async def _apply_menu_edit(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: int,
+                           mode: str, header: str):
+    """Edita a mensagem com o estado atual (chamada com o lock do chat)"""
+    chat = init_list(chat_id)
+    items = chat.items
+    # A mensagem deixa de exibir o que o cache do menu registrou
+    chat.menu_rendered = None
+    
+    shown = None
+    if mode == 'market' and items:
+        text, reply_markup, pending, _ = render_market_view(chat_id)
+        if not header:
+            shown = (message_id, pending)
+    else:
+        text = get_main_menu_text(chat)
+        reply_markup = get_main_menu_keyboard(len(items) > 0)
+    
+    if header:
+        text = f"{header}\n\n{text}"
+    
+    try:
+        if shown is not None and chat.pending_shown == shown:
+            # Texto idêntico ao que já está na tela: só o teclado muda
+            await context.bot.edit_message_reply_markup(
+                chat_id=chat_id,
+                message_id=message_id,
+                reply_markup=reply_markup
+            )
+        else:
             await context.bot.edit_message_text(
                 chat_id=chat_id,
-                message_id=menu_messages[chat_id],
-                text=menu_text,
-                parse_mode='HTML',
-                reply_markup=get_main_menu_keyboard(has_items)
+                message_id=message_id,
+                text=text,
+                reply_markup=reply_markup
             )
-            return
-        except BadRequest:
-            pass
-    
-    msg = await context.bot.send_message(
-        chat_id=chat_id,
-        text=menu_text,
-        parse_mode='HTML',
-        reply_markup=get_main_menu_keyboard(has_items)
+            # Com cabeçalho o texto difere da tela padrão do modo mercado
+            chat.pending_shown = shown
+    except RetryAfter:
+        # O AIORateLimiter já esperou e repetiu a chamada; o próximo clique reedita
+        # com o estado atual (reagendar daqui cancelaria uma edição mais nova)
+        logger.warning("⏳ Edição do menu descartada por flood control no chat %s", chat_id)
+    except BadRequest:
+        pass
+
+
+async def _run_menu_edit(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: int,
+                         mode: str, header: str, delay: float):
+    """Aguarda a janela de agrupamento e aplica a edição com o estado atual"""
+    await asyncio.sleep(delay)
+    # Edita sob o lock do chat: não se intercala com edit_or_send_menu nem com um botão
+    async with _chat_lock(chat_id):
+        # A partir daqui a edição não pode mais ser cancelada por um novo clique
+        if pending_edit_tasks.get(chat_id) is asyncio.current_task():
+            del pending_edit_tasks[chat_id]
+        await _apply_menu_edit(context, chat_id, message_id, mode, header)
+
+
+def schedule_menu_edit(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: int,
+                       mode: str, header: str = ""):
+    """Agenda a edição do menu, agrupando cliques rápidos numa única chamada à API
+    
+    mode: 'market' (teclado do modo mercado) ou 'menu' (menu principal).
+    """
+    now = time.monotonic()
+    # Primeiro clique depois de um tempo parado sai imediatamente;
+    # cliques em sequência esperam a janela e são agrupados
+    if now - last_edit_request.get(chat_id, 0.0) >= EDIT_DEBOUNCE:
+        delay = 0.0
+    else:
+        delay = EDIT_DEBOUNCE
+    last_edit_request[chat_id] = now
+    
+    cancel_scheduled_menu_edit(chat_id)
+    # Pela Application: erros vão para o tratamento do PTB e o desligamento aguarda a tarefa
+    pending_edit_tasks[chat_id] = context.application.create_task(
+        _run_menu_edit(context, chat_id, message_id, mode, header, delay)
     )
-    menu_messages[chat_id] = msg.message_id
+
+
+def _forget_chat(chat_id):
+    """Remove da memória tudo o que é guardado por chat"""
+    shopping_lists.pop(chat_id, None)
+    last_edit_request.pop(chat_id, None)
+    
+    lock = _chat_locks.get(chat_id)
+    if lock is not None and not lock.locked():
+        del _chat_locks[chat_id]
+
+
+async def _evict_idle_chats(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Job do JobQueue: descarta chats ociosos com a lista vazia"""
+    cutoff = time.monotonic() - CHAT_IDLE_TTL
+    idle = [
+        chat_id for chat_id, chat in shopping_lists.items()
+        if not chat.items and chat.last_activity < cutoff and chat_id not in pending_edit_tasks
+    ]
+    if not idle:
+        return
+    
+    for chat_id in idle:
+        _forget_chat(chat_id)
+    
+    idle_set = set(idle)
+    for key in [key for key in user_states if key[0] in idle_set]:
+        del user_states[key]
+    
+    logger.info("🧹 %d chat(s) ocioso(s) descartado(s)", len(idle))
 
 
 async def set_bot_commands(application: Application) -> None:
     """Define os comandos do bot"""
-    commands = [
-        BotCommand("start", "Menu principal"),
-        BotCommand("add", "Adicionar item"),
-        BotCommand("list", "Ver lista"),
-        BotCommand("remove", "Remover item"),
-        BotCommand("market", "Modo mercado"),
-        BotCommand("clear", "Limpar lista"),
-        BotCommand("cancel", "Cancelar"),
-    ]
+    commands = [BotCommand(name, description) for name, _, description in _COMMANDS]
+    # Inclui o token: trocar de bot invalida o hash salvo
+    digest = hashlib.sha256(
+        repr((application.bot.token, [(c.command, c.description) for c in commands])).encode()
+    ).hexdigest()
+    try:
+        with open(COMMANDS_HASH_PATH, encoding='utf-8') as f:
+            if f.read().strip() == digest:
+                logger.info("✅ Comandos já configurados")
+                return
+    except OSError:
+        pass
+    
     await application.bot.set_my_commands(commands)
     logger.info("✅ Comandos configurados!")
+    
+    try:
+        with open(COMMANDS_HASH_PATH, 'w', encoding='utf-8') as f:
+            f.write(digest)
+    except OSError as e:
+        logger.error("❌ Falha ao salvar hash dos comandos: %s", e)
+
+
+async def on_startup(application: Application) -> None:
+    """Configura comandos e tarefas periódicas ao iniciar"""
+    await set_bot_commands(application)
+    application.job_queue.run_repeating(_evict_idle_chats, interval=EVICT_INTERVAL, first=EVICT_INTERVAL)
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -217,33 +682,21 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
     
-    init_list(chat_id)
-    
     state_key = get_user_state_key(chat_id, user_id)
-    user_states[state_key] = STATE_NONE
+    user_states.pop(state_key, None)
     
-    await delete_message_safe(context, chat_id, update.message.message_id)
-    
-    if chat_id in menu_messages:
-        await delete_message_safe(context, chat_id, menu_messages[chat_id])
-    
-    items = shopping_lists[chat_id]['items']
-    menu_text = get_main_menu_text(items)
-    has_items = len(items) > 0
-    
-    msg = await context.bot.send_message(
-        chat_id=chat_id,
-        text=menu_text,
-        parse_mode='HTML',
-        reply_markup=get_main_menu_keyboard(has_items)
-    )
-    menu_messages[chat_id] = msg.message_id
+    delete_message_later(context, chat_id, update.message.message_id, 0)
+    # Sempre toca a API: se o menu foi apagado, a edição falha e um novo é enviado
+    invalidate_menu_cache(chat_id)
+    await update_menu(context, chat_id)
 
 
 async def show_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Comando /list"""
     chat_id = update.effective_chat.id
-    await delete_message_safe(context, chat_id, update.message.message_id)
+    delete_message_later(context, chat_id, update.message.message_id, 0)
+    # Pedido explícito do menu: não confia no cache (a mensagem pode ter sido apagada)
+    invalidate_menu_cache(chat_id)
     await update_menu(context, chat_id)
 
 
@@ -251,82 +704,50 @@ async def add_item_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     """Comando /add"""
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
-    user_name = update.effective_user.first_name
+    user_name = html.escape(update.effective_user.first_name)
     
     init_list(chat_id)
     
     state_key = get_user_state_key(chat_id, user_id)
     user_states[state_key] = STATE_ADDING
-    messages_to_delete[state_key] = []
     
-    await delete_message_safe(context, chat_id, update.message.message_id)
+    delete_message_later(context, chat_id, update.message.message_id, 0)
     
-    if chat_id in menu_messages:
-        try:
-            await context.bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=menu_messages[chat_id],
-                text=f"📝 <b>{user_name}</b>, digite o item a adicionar:",
-                parse_mode='HTML',
-                reply_markup=get_cancel_keyboard()
-            )
-            return
-        except BadRequest:
-            pass
-    
-    msg = await context.bot.send_message(
-        chat_id=chat_id,
-        text=f"📝 <b>{user_name}</b>, digite o item a adicionar:",
-        parse_mode='HTML',
-        reply_markup=get_cancel_keyboard()
+    invalidate_menu_cache(chat_id)
+    await edit_or_send_menu(
+        context, chat_id,
+        f"📝 <b>{user_name}</b>, digite o item a adicionar:",
+        _CANCEL_KB
     )
-    menu_messages[chat_id] = msg.message_id
 
 
 async def remove_item_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Comando /remove"""
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
-    user_name = update.effective_user.first_name
+    user_name = html.escape(update.effective_user.first_name)
     
-    init_list(chat_id)
-    items = shopping_lists[chat_id]['items']
+    chat = init_list(chat_id)
     
-    await delete_message_safe(context, chat_id, update.message.message_id)
+    delete_message_later(context, chat_id, update.message.message_id, 0)
     
-    if not items:
-        msg = await context.bot.send_message(chat_id=chat_id, text="📋 <b>Lista vazia!</b>", parse_mode='HTML')
-        await asyncio.sleep(2)
-        await delete_message_safe(context, chat_id, msg.message_id)
+    if not chat.items:
+        msg = await context.bot.send_message(chat_id=chat_id, text=_EMPTY_LIST_NOTICE)
+        delete_message_later(context, chat_id, msg.message_id, 2)
         await update_menu(context, chat_id)
         return
     
     state_key = get_user_state_key(chat_id, user_id)
     user_states[state_key] = STATE_REMOVING
-    messages_to_delete[state_key] = []
     
-    list_text = get_list_text(items, show_status=False)
+    list_text = get_list_text(chat, show_status=False)
     
-    if chat_id in menu_messages:
-        try:
-            await context.bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=menu_messages[chat_id],
-                text=f"📋 <b>Lista:</b>\n{list_text}\n\n🗑️ <b>{user_name}</b>, digite o número:",
-                parse_mode='HTML',
-                reply_markup=get_cancel_keyboard()
-            )
-            return
-        except BadRequest:
-            pass
-    
-    msg = await context.bot.send_message(
-        chat_id=chat_id,
-        text=f"📋 <b>Lista:</b>\n{list_text}\n\n🗑️ <b>{user_name}</b>, digite o número:",
-        parse_mode='HTML',
-        reply_markup=get_cancel_keyboard()
+    invalidate_menu_cache(chat_id)
+    await edit_or_send_menu(
+        context, chat_id,
+        f"📋 <b>Lista:</b>\n{list_text}\n\n🗑️ <b>{user_name}</b>, digite o número:",
+        _CANCEL_KB
     )
-    menu_messages[chat_id] = msg.message_id
 
 
 async def market_mode_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -334,87 +755,43 @@ async def market_mode_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
     
-    init_list(chat_id)
-    items = shopping_lists[chat_id]['items']
+    chat = init_list(chat_id)
     
-    await delete_message_safe(context, chat_id, update.message.message_id)
+    delete_message_later(context, chat_id, update.message.message_id, 0)
     
-    if not items:
-        msg = await context.bot.send_message(chat_id=chat_id, text="📋 <b>Lista vazia!</b>", parse_mode='HTML')
-        await asyncio.sleep(2)
-        await delete_message_safe(context, chat_id, msg.message_id)
+    if not chat.items:
+        msg = await context.bot.send_message(chat_id=chat_id, text=_EMPTY_LIST_NOTICE)
+        delete_message_later(context, chat_id, msg.message_id, 2)
         await update_menu(context, chat_id)
         return
     
     state_key = get_user_state_key(chat_id, user_id)
     user_states[state_key] = STATE_MARKET_MODE
     
-    pending = sum(1 for item in items if not item.get('bought', False))
+    invalidate_market_buttons(chat_id)
+    market_text, market_keyboard, pending, _ = render_market_view(chat_id)
     
-    if chat_id in menu_messages:
-        try:
-            await context.bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=menu_messages[chat_id],
-                text=f"🛒 <b>MODO MERCADO</b>\n━━━━━━━━━━━━━━━\nToque nos itens para marcar:\n\n📦 <b>{pending} pendente(s)</b>",
-                parse_mode='HTML',
-                reply_markup=get_market_mode_keyboard(items)
-            )
-            return
-        except BadRequest:
-            pass
-    
-    msg = await context.bot.send_message(
-        chat_id=chat_id,
-        text=f"🛒 <b>MODO MERCADO</b>\n━━━━━━━━━━━━━━━\nToque nos itens para marcar:\n\n📦 <b>{pending} pendente(s)</b>",
-        parse_mode='HTML',
-        reply_markup=get_market_mode_keyboard(items)
-    )
-    menu_messages[chat_id] = msg.message_id
+    invalidate_menu_cache(chat_id)
+    await edit_or_send_menu(context, chat_id, market_text, market_keyboard)
+    chat.pending_shown = (chat.menu_message_id, pending)
 
 
 async def clear_list_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Comando /clear"""
     chat_id = update.effective_chat.id
     
-    init_list(chat_id)
+    chat = init_list(chat_id)
     
-    await delete_message_safe(context, chat_id, update.message.message_id)
+    delete_message_later(context, chat_id, update.message.message_id, 0)
     
-    if not shopping_lists[chat_id]['items']:
-        msg = await context.bot.send_message(chat_id=chat_id, text="📋 <b>Lista já está vazia!</b>", parse_mode='HTML')
-        await asyncio.sleep(2)
-        await delete_message_safe(context, chat_id, msg.message_id)
+    if not chat.items:
+        msg = await context.bot.send_message(chat_id=chat_id, text=_ALREADY_EMPTY_NOTICE)
+        delete_message_later(context, chat_id, msg.message_id, 2)
         await update_menu(context, chat_id)
         return
     
-    keyboard = [
-        [
-            InlineKeyboardButton("✅ Sim, limpar", callback_data='confirm_clear'),
-            InlineKeyboardButton("❌ Não", callback_data='cancel_clear')
-        ]
-    ]
-    
-    if chat_id in menu_messages:
-        try:
-            await context.bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=menu_messages[chat_id],
-                text="⚠️ <b>Limpar toda a lista?</b>",
-                parse_mode='HTML',
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-            return
-        except BadRequest:
-            pass
-    
-    msg = await context.bot.send_message(
-        chat_id=chat_id,
-        text="⚠️ <b>Limpar toda a lista?</b>",
-        parse_mode='HTML',
-        reply_markup=InlineKeyboardMarkup(keyboard)
-    )
-    menu_messages[chat_id] = msg.message_id
+    invalidate_menu_cache(chat_id)
+    await edit_or_send_menu(context, chat_id, _CONFIRM_CLEAR_TEXT, _CONFIRM_CLEAR_KB)
 
 
 async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -423,283 +800,320 @@ async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     user_id = update.effective_user.id
     
     state_key = get_user_state_key(chat_id, user_id)
-    user_states[state_key] = STATE_NONE
+    user_states.pop(state_key, None)
     
-    await delete_message_safe(context, chat_id, update.message.message_id)
-    await cleanup_messages(context, chat_id, user_id)
+    delete_message_later(context, chat_id, update.message.message_id, 0)
     await update_menu(context, chat_id)
 
 
+async def _text_add(context: ContextTypes.DEFAULT_TYPE, chat_id: int, state_key, text: str):
+    """Texto recebido no estado ADICIONANDO"""
+    chat = init_list(chat_id)
+    
+    if len(text) < 2:
+        msg = await context.bot.send_message(chat_id=chat_id, text=_TOO_SHORT_NOTICE)
+        delete_message_later(context, chat_id, msg.message_id, 1.5)
+        return
+    
+    names_folded = chat.names_folded
+    # casefold compara sem caixa também fora do ASCII ("Straße" == "STRASSE")
+    text_folded = text.casefold()
+    if text_folded in names_folded:
+        user_states.pop(state_key, None)
+        msg = await context.bot.send_message(chat_id=chat_id, text=f"⚠️ <b>'{html.escape(text)}' já existe!</b>")
+        delete_message_later(context, chat_id, msg.message_id, 1.5)
+        await update_menu(context, chat_id)
+        return
+    
+    names_folded.add(text_folded)
+    item = Item(text)
+    chat.items.append(item)
+    chat.bought_flags.append(0)
+    chat.pending += 1
+    invalidate_market_buttons(chat_id)
+    chat.menu_text = None
+    chat.numbered_text = None
+    schedule_snapshot()
+    user_states.pop(state_key, None)
+    
+    # Confirmação vai no próprio menu: uma chamada à API em vez de três
+    await update_menu(context, chat_id, header=f"✅ <b>+{item.name_html}</b>")
+
+
+async def _text_remove(context: ContextTypes.DEFAULT_TYPE, chat_id: int, state_key, text: str):
+    """Texto recebido no estado REMOVENDO"""
+    chat = init_list(chat_id)
+    items = chat.items
+    
+    # isascii evita dígitos Unicode ("²") que o int() recusaria; o limite de
+    # tamanho barra números gigantes antes de chegarem ao int()
+    if not (len(text) <= 6 and text.isascii() and text.isdigit()):
+        msg = await context.bot.send_message(chat_id=chat_id, text=_NOT_A_NUMBER_NOTICE)
+        delete_message_later(context, chat_id, msg.message_id, 1.5)
+        return
+    
+    index = int(text) - 1
+    count = len(items)
+    
+    if index < 0 or index >= count:
+        msg = await context.bot.send_message(chat_id=chat_id, text=f"❌ <b>1 a {count}!</b>")
+        delete_message_later(context, chat_id, msg.message_id, 1.5)
+        return
+    
+    removed_item = items.pop(index)
+    was_bought = chat.bought_flags.pop(index)
+    invalidate_market_buttons(chat_id)
+    chat.names_folded.discard(removed_item.name.casefold())
+    if was_bought:
+        chat.bought -= 1
+    else:
+        chat.pending -= 1
+    chat.menu_text = None
+    chat.numbered_text = None
+    schedule_snapshot()
+    user_states.pop(state_key, None)
+    
+    await update_menu(context, chat_id, header=f"✅ <b>-{removed_item.name_html}</b>")
+
+
+_TEXT_HANDLERS = {
+    STATE_ADDING: _text_add,
+    STATE_REMOVING: _text_remove,
+}
+
+
 async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Processa mensagens de texto"""
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
-    text = update.message.text.strip()
-    user_name = update.effective_user.first_name
     
     state_key = get_user_state_key(chat_id, user_id)
-    current_state = user_states.get(state_key, STATE_NONE)
-    
-    if current_state == STATE_NONE:
+    handler = _TEXT_HANDLERS.get(user_states.get(state_key, STATE_NONE))
+    if handler is None:
         return
     
-    await delete_message_safe(context, chat_id, update.message.message_id)
-    
-    # ADICIONANDO
-    if current_state == STATE_ADDING:
-        init_list(chat_id)
-        
-        if len(text) < 2:
-            msg = await context.bot.send_message(chat_id=chat_id, text="❌ <b>Muito curto!</b>", parse_mode='HTML')
-            await asyncio.sleep(1.5)
-            await delete_message_safe(context, chat_id, msg.message_id)
-            return
-        
-        items_names = [item['name'].lower() for item in shopping_lists[chat_id]['items']]
-        if text.lower() in items_names:
-            user_states[state_key] = STATE_NONE
-            msg = await context.bot.send_message(chat_id=chat_id, text=f"⚠️ <b>'{text}' já existe!</b>", parse_mode='HTML')
-            await asyncio.sleep(1.5)
-            await delete_message_safe(context, chat_id, msg.message_id)
-            await update_menu(context, chat_id)
-            return
-        
-        shopping_lists[chat_id]['items'].append({'name': text, 'bought': False})
-        user_states[state_key] = STATE_NONE
-        
-        msg = await context.bot.send_message(chat_id=chat_id, text=f"✅ <b>+{text}</b>", parse_mode='HTML')
-        await asyncio.sleep(1)
-        await delete_message_safe(context, chat_id, msg.message_id)
-        await update_menu(context, chat_id)
-    
-    # REMOVENDO
-    elif current_state == STATE_REMOVING:
-        init_list(chat_id)
-        items = shopping_lists[chat_id]['items']
-        
-        try:
-            index = int(text) - 1
-            
-            if index < 0 or index >= len(items):
-                msg = await context.bot.send_message(chat_id=chat_id, text=f"❌ <b>1 a {len(items)}!</b>", parse_mode='HTML')
-                await asyncio.sleep(1.5)
-                await delete_message_safe(context, chat_id, msg.message_id)
-                return
-            
-            removed_item = items.pop(index)
-            user_states[state_key] = STATE_NONE
-            
-            msg = await context.bot.send_message(chat_id=chat_id, text=f"✅ <b>-{removed_item['name']}</b>", parse_mode='HTML')
-            await asyncio.sleep(1)
-            await delete_message_safe(context, chat_id, msg.message_id)
-            await update_menu(context, chat_id)
-            
-        except ValueError:
-            msg = await context.bot.send_message(chat_id=chat_id, text="❌ <b>Digite o número!</b>", parse_mode='HTML')
-            await asyncio.sleep(1.5)
-            await delete_message_safe(context, chat_id, msg.message_id)
+    delete_message_later(context, chat_id, update.message.message_id, 0)
+    await handler(context, chat_id, state_key, update.message.text.strip())
 
 
-async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Processa cliques nos botões"""
-    query = update.callback_query
-    chat_id = query.message.chat_id
-    user_id = query.from_user.id
-    user_name = query.from_user.first_name
+async def _cb_add(query, context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int, user_name: str):
+    """Botão ➕ Adicionar"""
+    state_key = get_user_state_key(chat_id, user_id)
+    user_states[state_key] = STATE_ADDING
     
-    await query.answer()
+    await query.edit_message_text(
+        f"📝 <b>{user_name}</b>, digite o item a adicionar:",
+        reply_markup=_CANCEL_KB
+    )
+
+
+async def _cb_remove(query, context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int, user_name: str):
+    """Botão ➖ Remover"""
+    chat = shopping_lists[chat_id]
     
     state_key = get_user_state_key(chat_id, user_id)
-    init_list(chat_id)
+    user_states[state_key] = STATE_REMOVING
     
-    # ADICIONAR
-    if query.data == 'action_add':
-        user_states[state_key] = STATE_ADDING
-        messages_to_delete[state_key] = []
-        
-        await query.edit_message_text(
-            f"📝 <b>{user_name}</b>, digite o item a adicionar:",
-            parse_mode='HTML',
-            reply_markup=get_cancel_keyboard()
-        )
+    list_text = get_list_text(chat, show_status=False)
+    await query.edit_message_text(
+        f"📋 <b>Lista:</b>\n{list_text}\n\n🗑️ <b>{user_name}</b>, digite o número:",
+        reply_markup=_CANCEL_KB
+    )
+
+
+async def _cb_market_mode(query, context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int, user_name: str):
+    """Botão 🛒 Modo Mercado"""
+    user_states[get_user_state_key(chat_id, user_id)] = STATE_MARKET_MODE
+    invalidate_market_buttons(chat_id)
+    market_text, market_keyboard, pending, _ = render_market_view(chat_id)
+    
+    await query.edit_message_text(
+        market_text,
+        reply_markup=market_keyboard
+    )
+    shopping_lists[chat_id].pending_shown = (query.message.message_id, pending)
+
+
+async def _cb_toggle(query, context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int, user_name: str):
+    """Marca/desmarca um item no modo mercado"""
+    index = int(query.data[_TOGGLE_PREFIX_LEN:])
+    chat = shopping_lists[chat_id]
+    flags = chat.bought_flags
+    
+    if 0 <= index < len(flags):
+        flags[index] ^= 1
+        delta = 1 if flags[index] else -1
+        chat.bought += delta
+        chat.pending -= delta
+        chat.menu_text = None
+        schedule_snapshot()
+    
+    schedule_menu_edit(context, chat_id, query.message.message_id, 'market')
+
+
+async def _cb_market_finish(query, context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int, user_name: str):
+    """Finaliza o modo mercado mantendo as marcações"""
+    user_states.pop(get_user_state_key(chat_id, user_id), None)
+    chat = shopping_lists[chat_id]
     
-    # REMOVER
-    elif query.data == 'action_remove':
-        items = shopping_lists[chat_id]['items']
-        
-        if not items:
-            await query.edit_message_text(
-                "📋 <b>Lista vazia!</b>\n\nUse ➕ Adicionar para começar.",
-                parse_mode='HTML',
-                reply_markup=get_main_menu_keyboard(False)
-            )
-            return
-        
-        user_states[state_key] = STATE_REMOVING
-        messages_to_delete[state_key] = []
-        
-        list_text = get_list_text(items, show_status=False)
-        await query.edit_message_text(
-            f"📋 <b>Lista:</b>\n{list_text}\n\n🗑️ <b>{user_name}</b>, digite o número:",
-            parse_mode='HTML',
-            reply_markup=get_cancel_keyboard()
-        )
+    menu_text = get_main_menu_text(chat)
     
-    # MODO MERCADO
-    elif query.data == 'action_market_mode':
-        items = shopping_lists[chat_id]['items']
-        
-        if not items:
-            await query.edit_message_text(
-                "📋 <b>Lista vazia!</b>",
-                parse_mode='HTML',
-                reply_markup=get_main_menu_keyboard(False)
-            )
-            return
-        
-        user_states[state_key] = STATE_MARKET_MODE
-        pending = sum(1 for item in items if not item.get('bought', False))
-        
-        await query.edit_message_text(
-            f"🛒 <b>MODO MERCADO</b>\n━━━━━━━━━━━━━━━\nToque nos itens para marcar:\n\n📦 <b>{pending} pendente(s)</b>",
-            parse_mode='HTML',
-            reply_markup=get_market_mode_keyboard(items)
-        )
+    await query.edit_message_text(
+        f"✅ <b>Compras finalizadas!</b>\n{chat.bought} item(ns) marcado(s)\n\n{menu_text}",
+        reply_markup=get_main_menu_keyboard(len(chat.items) > 0)
+    )
+
+
+async def _cb_market_cancel(query, context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int, user_name: str):
+    """Cancela o modo mercado desmarcando tudo"""
+    user_states.pop(get_user_state_key(chat_id, user_id), None)
+    chat = shopping_lists[chat_id]
+    
+    items = chat.items
+    chat.bought_flags = bytearray(len(items))
+    chat.pending = len(items)
+    chat.bought = 0
+    chat.menu_text = None
+    schedule_snapshot()
+    
+    await show_menu_on_query(query, chat_id)
+
+
+async def _cb_market_clear_bought(query, context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int, user_name: str):
+    """Remove da lista os itens já comprados"""
+    chat = shopping_lists[chat_id]
+    
+    flags = chat.bought_flags
+    removed_count = flags.count(1)
+    chat.items = [item for item, flag in zip(chat.items, flags) if not flag]
+    chat.bought_flags = bytearray(len(chat.items))
+    chat.names_folded = {item.name.casefold() for item in chat.items}
+    invalidate_market_buttons(chat_id)
+    chat.pending = len(chat.items)
+    chat.bought = 0
+    chat.menu_text = None
+    chat.numbered_text = None
+    schedule_snapshot()
+    
+    if not chat.items:
+        user_states.pop(get_user_state_key(chat_id, user_id), None)
+    
+    schedule_menu_edit(
+        context, chat_id, query.message.message_id, 'market',
+        header=f"🧹 <b>{removed_count} item(ns) removido(s)!</b>"
+    )
+
+
+async def _cb_clear(query, context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int, user_name: str):
+    """Botão 🗑️ Limpar Tudo"""
+    await query.edit_message_text(
+        _CONFIRM_CLEAR_TEXT,
+        reply_markup=_CONFIRM_CLEAR_KB
+    )
+
+
+async def _cb_cancel(query, context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int, user_name: str):
+    """Botão ❌ Cancelar (adicionar/remover)"""
+    user_states.pop(get_user_state_key(chat_id, user_id), None)
+    await show_menu_on_query(query, chat_id)
+
+
+async def _cb_confirm_clear(query, context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int, user_name: str):
+    """Confirma a limpeza da lista"""
+    chat = shopping_lists[chat_id]
+    chat.items.clear()
+    chat.bought_flags.clear()
+    chat.names_folded.clear()
+    invalidate_market_buttons(chat_id)
+    chat.pending = 0
+    chat.bought = 0
+    chat.menu_text = None
+    chat.numbered_text = None
+    schedule_snapshot()
+    
+    schedule_menu_edit(context, chat_id, query.message.message_id, 'menu')
+
+
+async def _cb_cancel_clear(query, context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int, user_name: str):
+    """Desiste da limpeza e volta ao menu"""
+    await show_menu_on_query(query, chat_id)
+
+
+# Ações que exigem lista com itens: com a lista vazia, só mostra um aviso rápido
+_EMPTY_LIST_TOASTS = {
+    'action_remove': "📋 Lista vazia! Use ➕ Adicionar para começar.",
+    'action_market_mode': "📋 Lista vazia!",
+    'action_clear': "📋 Lista já está vazia!",
+}
+
+
+# Ações que devolvem o menu principal (consultam o cache em vez de descartá-lo)
+_MENU_RESTORING_CALLBACKS = {'market_cancel', 'action_cancel', 'cancel_clear'}
+
+
+# callback_data -> handler (toggle_<i> é tratado à parte, pelo prefixo)
+_CB_HANDLERS = {
+    'action_add': _cb_add,
+    'action_remove': _cb_remove,
+    'action_market_mode': _cb_market_mode,
+    'market_finish': _cb_market_finish,
+    'market_cancel': _cb_market_cancel,
+    'market_clear_bought': _cb_market_clear_bought,
+    'action_clear': _cb_clear,
+    'action_cancel': _cb_cancel,
+    'confirm_clear': _cb_confirm_clear,
+    'cancel_clear': _cb_cancel_clear,
+}
+
+
+async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Processa cliques nos botões"""
+    query = update.callback_query
+    chat_id = query.message.chat_id
+    data = query.data
     
-    # TOGGLE ITEM
-    elif query.data.startswith('toggle_'):
-        index = int(query.data.split('_')[1])
-        items = shopping_lists[chat_id]['items']
-        
-        if 0 <= index < len(items):
-            items[index]['bought'] = not items[index].get('bought', False)
-        
-        pending = sum(1 for item in items if not item.get('bought', False))
-        
-        await query.edit_message_text(
-            f"🛒 <b>MODO MERCADO</b>\n━━━━━━━━━━━━━━━\nToque nos itens para marcar:\n\n📦 <b>{pending} pendente(s)</b>",
-            parse_mode='HTML',
-            reply_markup=get_market_mode_keyboard(items)
-        )
+    chat = init_list(chat_id)
     
-    # FINALIZAR MODO MERCADO
-    elif query.data == 'market_finish':
-        user_states[state_key] = STATE_NONE
-        items = shopping_lists[chat_id]['items']
-        
-        bought_count = sum(1 for item in items if item.get('bought', False))
-        
-        menu_text = get_main_menu_text(items)
-        has_items = len(items) > 0
-        
-        await query.edit_message_text(
-            f"✅ <b>Compras finalizadas!</b>\n{bought_count} item(ns) marcado(s)\n\n{menu_text}",
-            parse_mode='HTML',
-            reply_markup=get_main_menu_keyboard(has_items)
-        )
-    
-    # CANCELAR MODO MERCADO
-    elif query.data == 'market_cancel':
-        user_states[state_key] = STATE_NONE
-        
-        items = shopping_lists[chat_id]['items']
-        for item in items:
-            item['bought'] = False
-        
-        menu_text = get_main_menu_text(items)
-        has_items = len(items) > 0
-        
-        await query.edit_message_text(
-            menu_text,
-            parse_mode='HTML',
-            reply_markup=get_main_menu_keyboard(has_items)
-        )
+    if data in _EMPTY_LIST_TOASTS and not chat.items:
+        # Um único answerCallbackQuery, sem mexer no menu
+        await query.answer(text=_EMPTY_LIST_TOASTS[data], show_alert=False)
+        return
     
-    # REMOVER COMPRADOS
-    elif query.data == 'market_clear_bought':
-        items = shopping_lists[chat_id]['items']
-        
-        removed_count = sum(1 for item in items if item.get('bought', False))
-        shopping_lists[chat_id]['items'] = [item for item in items if not item.get('bought', False)]
-        
-        items = shopping_lists[chat_id]['items']
-        
-        if items:
-            pending = sum(1 for item in items if not item.get('bought', False))
-            await query.edit_message_text(
-                f"🧹 <b>{removed_count} item(ns) removido(s)!</b>\n\n🛒 <b>MODO MERCADO</b>\n━━━━━━━━━━━━━━━\n📦 <b>{pending} pendente(s)</b>",
-                parse_mode='HTML',
-                reply_markup=get_market_mode_keyboard(items)
-            )
-        else:
-            user_states[state_key] = STATE_NONE
-            menu_text = get_main_menu_text([])
-            await query.edit_message_text(
-                f"🧹 <b>{removed_count} item(ns) removido(s)!</b>\n\n{menu_text}",
-                parse_mode='HTML',
-                reply_markup=get_main_menu_keyboard(False)
-            )
+    await query.answer()
     
-    # LIMPAR TUDO
-    elif query.data == 'action_clear':
-        if not shopping_lists[chat_id]['items']:
-            await query.edit_message_text(
-                "📋 <b>Lista já está vazia!</b>",
-                parse_mode='HTML',
-                reply_markup=get_main_menu_keyboard(False)
-            )
+    if data.startswith(_TOGGLE_PREFIX):
+        handler = _cb_toggle
+    else:
+        handler = _CB_HANDLERS.get(data)
+        if handler is None:
             return
-        
-        keyboard = [
-            [
-                InlineKeyboardButton("✅ Sim", callback_data='confirm_clear'),
-                InlineKeyboardButton("❌ Não", callback_data='cancel_clear')
-            ]
-        ]
-        
-        await query.edit_message_text(
-            "⚠️ <b>Limpar toda a lista?</b>",
-            parse_mode='HTML',
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
     
-    # CANCELAR
-    elif query.data == 'action_cancel':
-        user_states[state_key] = STATE_NONE
-        await cleanup_messages(context, chat_id, user_id)
-        
-        items = shopping_lists[chat_id]['items']
-        menu_text = get_main_menu_text(items)
-        has_items = len(items) > 0
-        
-        await query.edit_message_text(
-            menu_text,
-            parse_mode='HTML',
-            reply_markup=get_main_menu_keyboard(has_items)
-        )
+    # Nome entra em texto HTML: escapa uma vez aqui para todos os handlers
+    user_name = html.escape(query.from_user.first_name)
     
-    # CONFIRMAR LIMPEZA
-    elif query.data == 'confirm_clear':
-        shopping_lists[chat_id]['items'] = []
-        
-        menu_text = get_main_menu_text([])
-        await query.edit_message_text(
-            menu_text,
-            parse_mode='HTML',
-            reply_markup=get_main_menu_keyboard(False)
-        )
+    if data in _MENU_RESTORING_CALLBACKS:
+        # show_menu_on_query consulta e grava o cache sob o lock do chat
+        cancel_scheduled_menu_edit(chat_id)
+        await handler(query, context, chat_id, query.from_user.id, user_name)
+        return
     
-    # CANCELAR LIMPEZA
-    elif query.data == 'cancel_clear':
-        items = shopping_lists[chat_id]['items']
-        menu_text = get_main_menu_text(items)
-        has_items = len(items) > 0
-        
-        await query.edit_message_text(
-            menu_text,
-            parse_mode='HTML',
-            reply_markup=get_main_menu_keyboard(has_items)
-        )
+    # As demais ações reescrevem a mensagem do menu com outro conteúdo: invalida e
+    # edita sob o lock, para um update_menu concorrente não gravar no cache o que saiu da tela
+    async with _chat_lock(chat_id):
+        invalidate_menu_cache(chat_id)
+        await handler(query, context, chat_id, query.from_user.id, user_name)
+
+
+# Comandos do bot: registro dos handlers e menu do Telegram saem daqui
+_COMMANDS = (
+    ("start", start, "Menu principal"),
+    ("add", add_item_command, "Adicionar item"),
+    ("list", show_list, "Ver lista"),
+    ("remove", remove_item_command, "Remover item"),
+    ("market", market_mode_command, "Modo mercado"),
+    ("clear", clear_list_command, "Limpar lista"),
+    ("cancel", cancel_command, "Cancelar"),
+)
 
 
 def main() -> None:
@@ -710,24 +1124,61 @@ def main() -> None:
         logger.error("❌ ERRO: BOT_TOKEN não encontrado!")
         return
     
-    logger.info(f"✅ Token: {bot_token[:20]}...")
-    
-    application = Application.builder().token(bot_token).build()
+    logger.info("✅ Token: %s...", bot_token[:20])
+    
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    
+    # Atualizações de chats diferentes são processadas em paralelo;
+    # HTTP/2 multiplexa as chamadas simultâneas à API na mesma conexão
+    # e o rate limiter segura o teto global de 30 msg/s do Telegram
+    application = (
+        Application.builder()
+        .token(bot_token)
+        .concurrent_updates(True)
+        # HTML em todas as mensagens e handlers sem bloquear a fila de updates
+        .defaults(Defaults(parse_mode=ParseMode.HTML, block=False))
+        .rate_limiter(AIORateLimiter(
+            overall_max_rate=30, overall_time_period=1,
+            group_max_rate=20, group_time_period=60,
+            max_retries=3
+        ))
+        .request(OrjsonRequest(
+            connection_pool_size=256,
+            http_version='2',
+            pool_timeout=5.0,
+            connect_timeout=5.0,
+            read_timeout=10.0
+        ))
+        .get_updates_request(OrjsonRequest(http_version='2'))
+        .build()
+    )
     
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("list", show_list))
-    application.add_handler(CommandHandler("add", add_item_command))
-    application.add_handler(CommandHandler("remove", remove_item_command))
-    application.add_handler(CommandHandler("market", market_mode_command))
-    application.add_handler(CommandHandler("clear", clear_list_command))
-    application.add_handler(CommandHandler("cancel", cancel_command))
+    for name, callback, _ in _COMMANDS:
+        application.add_handler(CommandHandler(name, callback))
     application.add_handler(CallbackQueryHandler(button_callback))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
-    
-    application.post_init = set_bot_commands
-    
-    logger.info("🤖 Bot iniciado!")
-    application.run_polling()
+    application.add_handler(MessageHandler(TEXT_INPUT_FILTER, handle_text_message))
+    
+    load_snapshot()
+    
+    application.post_init = on_startup
+    application.post_shutdown = save_snapshot_now
+    
+    # Com WEBHOOK_URL definido o Telegram empurra as atualizações;
+    # sem ele, segue no long polling (worker do Procfile)
+    webhook_url = os.getenv('WEBHOOK_URL')
+    if webhook_url:
+        logger.info("🤖 Bot iniciado (webhook)!")
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=int(os.getenv('PORT', '8443')),
+            url_path=bot_token,
+            webhook_url=f"{webhook_url.rstrip('/')}/{bot_token}",
+            secret_token=os.getenv('WEBHOOK_SECRET')
+        )
+    else:
+        logger.info("🤖 Bot iniciado!")
+        application.run_polling()
 
 
 if __name__ == '__main__':